@@ -18,17 +18,20 @@ Based on: Cellpose by Stringer et al. (https://github.com/MouseLand/cellpose)
 
 import os
 import sys
+from pathlib import Path
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import logging
+import queue
 import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import glob
 import numpy as np
 
 # Import Cellpose components
 try:
-    from cellpose import models, io, utils
+    from cellpose import models, io
     from cellpose.io import logger_setup
     import tifffile
     from PIL import Image
@@ -38,6 +41,68 @@ except ImportError as e:
     print("pip install cellpose[gui] tifffile pillow")
     sys.exit(1)
 
+# Segmentation, tiling and outline helpers shared with the command-line script
+from automated_cellpose_segmentation import (
+    fast_outlines, inference_context, load_image, needs_tiling, segment_images, segment_tiled)
+
+# PyTorch is installed with Cellpose; guarded so CPU-only setups still start
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# Optional GPU array backend for mask post-processing (falls back to NumPy)
+try:
+    import cupy as cp
+    CUPY_AVAILABLE = cp.cuda.is_available()
+except Exception:
+    cp = None
+    CUPY_AVAILABLE = False
+
+xp = cp if CUPY_AVAILABLE else np
+
+# Masks larger than this are post-processed with NumPy, since the CuPy temporaries are several times the mask size
+CUPY_MAX_PIXELS = 64 * 1024 * 1024
+
+# Optional faster PNG encoder (falls back to PIL)
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Optional JIT for the CPU color gather when CuPy is not in use
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _colorize(masks, palette, out):
+        """Write palette colors for each label into out, parallelized over rows"""
+        n_colors = palette.shape[0] - 1
+        for y in prange(masks.shape[0]):
+            for x in range(masks.shape[1]):
+                label = np.int64(masks[y, x])
+                c = (label - 1) % n_colors + 1 if label > 0 else 0
+                out[y, x, 0] = palette[c, 0]
+                out[y, x, 1] = palette[c, 1]
+                out[y, x, 2] = palette[c, 2]
+else:
+    _colorize = None
+
+def to_host(array):
+    """Return a NumPy array, copying it back from the GPU if needed"""
+    if cp is not None and isinstance(array, cp.ndarray):
+        return cp.asnumpy(array)
+    return array
+
+# Interval for pushing queued log lines and progress to the Tk widgets
+UI_REFRESH_MS = 100
+
+# A pending TIFF write for the background writer thread; source is the input image it belongs to
+WriteJob = namedtuple('WriteJob', ['path', 'arr', 'kw', 'label', 'source'])
+
 class EnhancedCellposeGUI:
     def __init__(self, root):
         self.root = root
@@ -52,6 +117,7 @@ class EnhancedCellposeGUI:
         self.output_folder = tk.StringVar()
         self.model_var = tk.StringVar(value="cpsam")
         self.diameter_var = tk.StringVar(value="Auto")
+        self.batch_size_var = tk.StringVar(value="4")
         
         # Output selection variables
         self.save_masks = tk.BooleanVar(value=True)
@@ -61,19 +127,47 @@ class EnhancedCellposeGUI:
         self.save_flow_rgb = tk.BooleanVar(value=False)
         self.save_png_masks = tk.BooleanVar(value=False)
         
+        # Storage options for .tif outputs
+        self.compress_tiffs = tk.BooleanVar(value=True)
+        self.half_precision = tk.BooleanVar(value=True)
+        
         # Progress variables
         self.progress_var = tk.DoubleVar()
         self.current_file_var = tk.StringVar(value="Ready to start...")
         self.total_files = 0
         self.processed_files = 0
+        self._progress_state = None
+        self._shown_progress_state = None
         
         # Processing state
         self.is_processing = False
         self.processing_thread = None
         
+        # Fixed mask color palette (entry 0 is the black background)
+        rng = np.random.default_rng(42)
+        self._palette = rng.integers(0, 255, (1024, 3), dtype=np.uint8)
+        self._palette[0] = 0
+        self._palette_dev = xp.asarray(self._palette)
+        
+        # Loaded models, reused across runs
+        self._model_cache = {}
+        
+        # Input file listings keyed by folder, with the folder mtime they were built at
+        self._tif_cache = {}
+        
+        # Background I/O: image prefetch overlaps GPU compute
+        self._io_pool = ThreadPoolExecutor(max_workers=4)
+        
         self.setup_gui()
         self.setup_logging()
         
+        # Dedicated writer thread; the bounded queue caps memory held by pending writes
+        self._writer_q = queue.Queue(maxsize=8)
+        self._write_failures = set()  # Input files with an output the writer could not save
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+        self.root.after(UI_REFRESH_MS, self.refresh_progress)
+        
     def setup_gui(self):
         """Setup the enhanced GUI interface"""
         # Main container
@@ -126,6 +220,12 @@ class EnhancedCellposeGUI:
                                     values=["Auto", "10", "15", "20", "25", "30", "35", "40"], state="readonly")
         diameter_combo.grid(row=0, column=3, sticky=tk.W, padx=(5, 0))
         
+        # Batch size setting
+        ttk.Label(model_frame, text="Batch Size:").grid(row=1, column=0, sticky=tk.W, pady=2)
+        batch_combo = ttk.Combobox(model_frame, textvariable=self.batch_size_var, 
+                                 values=["1", "2", "4", "8", "16"], state="readonly")
+        batch_combo.grid(row=1, column=1, sticky=tk.W, padx=(5, 0))
+        
         # Output Selection Section
         output_frame = ttk.LabelFrame(main_frame, text="Output File Selection", padding="10")
         output_frame.grid(row=row, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(0, 10))
@@ -154,6 +254,12 @@ class EnhancedCellposeGUI:
         ttk.Checkbutton(checkbox_frame2, text="PNG Mask Visualizations (.png)", 
                        variable=self.save_png_masks).grid(row=2, column=0, sticky=tk.W, pady=2)
         
+        # Storage options
+        ttk.Checkbutton(checkbox_frame1, text="Compress TIFF Outputs (zlib)", 
+                       variable=self.compress_tiffs).grid(row=3, column=0, sticky=tk.W, pady=(8, 2))
+        ttk.Checkbutton(checkbox_frame2, text="Half-Precision Flows/Cellprob", 
+                       variable=self.half_precision).grid(row=3, column=0, sticky=tk.W, pady=(8, 2))
+        
         # Progress Section
         progress_frame = ttk.LabelFrame(main_frame, text="Processing Progress", padding="10")
         progress_frame.grid(row=row, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(0, 10))
@@ -237,28 +343,42 @@ class EnhancedCellposeGUI:
             
     def get_tif_files(self, input_folder):
         """Get all .tif and .tiff files from the input folder"""
-        tif_patterns = ['*.tif', '*.tiff', '*.TIF', '*.TIFF']
-        tif_files = []
-        
-        for pattern in tif_patterns:
-            tif_files.extend(glob.glob(os.path.join(input_folder, pattern)))
+        # Reuse the previous listing unless the folder has changed since
+        mtime = os.stat(input_folder).st_mtime
+        cached = self._tif_cache.get(input_folder)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+            
+        # Single directory pass with a case-insensitive extension test
+        with os.scandir(input_folder) as entries:
+            tif_files = sorted(entry.path for entry in entries
+                               if entry.is_file() and not entry.name.startswith('.')
+                               and entry.name.lower().endswith(('.tif', '.tiff')))
         
-        # Remove duplicates and sort
-        return sorted(list(set(tif_files)))
+        self._tif_cache[input_folder] = (mtime, tif_files)
+        return tif_files
         
     def update_progress(self, current, total, current_file=""):
-        """Update progress bar and labels"""
-        if total > 0:
-            percentage = (current / total) * 100
-            self.progress_var.set(percentage)
-            self.progress_label.config(text=f"{current}/{total} ({percentage:.1f}%)")
-            
-            if current_file:
-                self.current_file_var.set(f"Processing: {os.path.basename(current_file)}")
-            elif current >= total:
-                self.current_file_var.set("Processing completed!")
+        """Record progress; the widgets are refreshed from the Tk main loop"""
+        self._progress_state = (current, total, current_file)
+        
+    def refresh_progress(self):
+        """Update progress bar and labels with the latest recorded progress"""
+        state = self._progress_state
+        if state is not None and state is not self._shown_progress_state:
+            self._shown_progress_state = state
+            current, total, current_file = state
+            if total > 0:
+                percentage = (current / total) * 100
+                self.progress_var.set(percentage)
+                self.progress_label.config(text=f"{current}/{total} ({percentage:.1f}%)")
                 
-        self.root.update_idletasks()
+                if current_file:
+                    self.current_file_var.set(f"Processing: {os.path.basename(current_file)}")
+                elif current >= total:
+                    self.current_file_var.set("Processing completed!")
+                    
+        self.root.after(UI_REFRESH_MS, self.refresh_progress)
         
     def start_processing(self):
         """Start the batch processing in a separate thread"""
@@ -306,10 +426,12 @@ class EnhancedCellposeGUI:
                                  "Processing is currently running. Do you want to stop and exit?"):
                 self.stop_processing()
                 self.logger.info("Application closing - processing stopped by user")
+                self.shutdown_io()
                 self.root.quit()
                 self.root.destroy()
         else:
             self.logger.info("Application closing")
+            self.shutdown_io()
             self.root.quit()
             self.root.destroy()
         
@@ -320,6 +442,7 @@ class EnhancedCellposeGUI:
             output_folder = self.output_folder.get()
             model_name = self.model_var.get()
             diameter_str = self.diameter_var.get()
+            batch_size = int(self.batch_size_var.get())
             
             # Parse diameter
             diameter = None if diameter_str == "Auto" else float(diameter_str)
@@ -331,7 +454,9 @@ class EnhancedCellposeGUI:
                 'save_cellprob': self.save_cellprob.get(),
                 'save_outlines': self.save_outlines.get(),
                 'save_flow_rgb': self.save_flow_rgb.get(),
-                'save_png_masks': self.save_png_masks.get()
+                'save_png_masks': self.save_png_masks.get(),
+                'compress_tiffs': self.compress_tiffs.get(),
+                'half_precision': self.half_precision.get()
             }
             
             self.logger.info("Starting batch processing...")
@@ -339,8 +464,13 @@ class EnhancedCellposeGUI:
             self.logger.info(f"Output folder: {output_folder}")
             self.logger.info(f"Model: {model_name}")
             self.logger.info(f"Diameter: {diameter_str}")
+            self.logger.info(f"Batch size: {batch_size}")
             self.logger.info(f"Output options: {[k for k, v in output_options.items() if v]}")
             
+            # Flow outputs are large; only keep them when one of them will be saved
+            need_flows = (output_options['save_flows'] or output_options['save_cellprob']
+                          or output_options['save_flow_rgb'])
+            
             # Get list of files
             tif_files = self.get_tif_files(input_folder)
             self.total_files = len(tif_files)
@@ -351,57 +481,85 @@ class EnhancedCellposeGUI:
                 
             self.logger.info(f"Found {self.total_files} files to process")
             
-            # Initialize model
-            self.logger.info(f"Loading Cellpose model: {model_name}")
-            model_instance = models.CellposeModel(gpu=True, pretrained_model=model_name)
+            # Initialize model (reused across runs)
+            model_instance = self.get_model(model_name, diameter)
             
-            # Process each file
+            # Process files in mini-batches, reading the next batch while the current one runs
             success_count = 0
-            for i, tif_file in enumerate(tif_files):
+            saved_files = []
+            self._write_failures.clear()
+            pending_reads = self.submit_reads(tif_files[:batch_size])
+            for start in range(0, self.total_files, batch_size):
                 if not self.is_processing:
                     break
                     
-                try:
-                    self.update_progress(i, self.total_files, tif_file)
-                    self.logger.info(f"Processing file {i+1}/{self.total_files}: {os.path.basename(tif_file)}")
-                    
-                    # Load image
-                    img = io.imread(tif_file)
-                    
-                    # Run segmentation
-                    result = model_instance.eval(
-                        img, 
-                        diameter=diameter,
-                        flow_threshold=0.4,
-                        cellprob_threshold=0.0
-                    )
-                    
-                    # Handle variable return values
-                    if len(result) == 4:
-                        masks, flows, styles, diams = result
-                    elif len(result) == 3:
-                        masks, flows, styles = result
-                        diams = None
-                    else:
-                        raise ValueError(f"Unexpected eval return format: {len(result)} values")
-                    
-                    # Count cells
-                    if isinstance(masks, list):
-                        cell_count = len(masks) if masks else 0
-                    else:
-                        cell_count = len(np.unique(masks)) - 1 if 0 in np.unique(masks) else len(np.unique(masks))
+                # Collect images for this batch
+                batch = []
+                for i, (tif_file, future) in enumerate(pending_reads, start):
+                    file_name = os.path.basename(tif_file)
+                    try:
+                        self.update_progress(i, self.total_files, tif_file)
+                        self.logger.info(f"Processing file {i+1}/{self.total_files}: {file_name}")
+                        batch.append((tif_file, future.result()))
+                    except Exception as e:
+                        self.logger.error(f"Error loading {file_name}: {str(e)}")
+                        
+                next_start = start + batch_size
+                pending_reads = self.submit_reads(tif_files[next_start:next_start + batch_size])
+                
+                if not batch:
+                    continue
                     
-                    self.logger.info(f"Segmentation completed - found {cell_count} cells")
+                # Run segmentation
+                try:
+                    results = self.segment_batch(model_instance, [img for _, img in batch], diameter,
+                                                 keep_flows=need_flows)
+                except Exception as e:
+                    if len(batch) == 1:
+                        self.logger.error(f"Error segmenting {os.path.basename(batch[0][0])}: {str(e)}")
+                        continue
+                    # One bad image should not fail the rest of its batch
+                    self.logger.warning(f"Batch segmentation failed ({str(e)}), retrying images one at a time")
+                    results = None
                     
-                    # Save outputs based on selection
-                    self.save_outputs(tif_file, img, masks, flows, output_folder, output_options)
+                # Retry outside the handler so the failed call's frames (and GPU memory) are released first
+                if results is None:
+                    results = self.segment_individually(model_instance, batch, diameter, keep_flows=need_flows)
                     
+                for (tif_file, img), result in zip(batch, results):
+                    if result is None:
+                        continue
+                    masks, flows = result
+                    file_name = os.path.basename(tif_file)
+                    try:
+                        # Count cells
+                        if isinstance(masks, list):
+                            cell_count = len(masks) if masks else 0
+                        else:
+                            # Linear-time label histogram (sized by bincount itself, no separate max pass)
+                            cell_count = int(np.count_nonzero(np.bincount(masks.ravel())[1:]))
+                        
+                        self.logger.info(f"Segmentation completed for {file_name} - found {cell_count} cells")
+                        
+                        # Save outputs based on selection
+                        self.save_outputs(tif_file, img, masks, flows, output_folder, output_options)
+                        saved_files.append(tif_file)
+                        
+                    except Exception as e:
+                        self.logger.error(f"Error processing {file_name}: {str(e)}")
+                        continue
+                    finally:
+                        # Hand cached CuPy blocks back to the driver before the next inference
+                        self.free_gpu_arrays()
+            
+            # Wait for queued writes; a file only counts as processed once its outputs are on disk
+            self.wait_for_writes()
+            for tif_file in saved_files:
+                if tif_file in self._write_failures:
+                    self.logger.error(f"Error processing {os.path.basename(tif_file)}: outputs could not be written")
+                else:
                     success_count += 1
                     self.processed_files += 1
-                    
-                except Exception as e:
-                    self.logger.error(f"Error processing {os.path.basename(tif_file)}: {str(e)}")
-                    continue
             
             # Final update
             self.update_progress(self.total_files, self.total_files)
@@ -410,14 +568,106 @@ class EnhancedCellposeGUI:
         except Exception as e:
             self.logger.error(f"Processing error: {str(e)}")
         finally:
+            self.wait_for_writes()
+            
             # Re-enable buttons
             self.start_button.config(state="normal")
             self.stop_button.config(state="disabled")
             self.is_processing = False
             
+    def submit_reads(self, tif_files):
+        """Queue background reads, returning (path, future) pairs in order"""
+        return [(tif_file, self._io_pool.submit(load_image, tif_file)) for tif_file in tif_files]
+        
+    def submit_write(self, path, arr, label, source, **kw):
+        """Queue a TIFF write for the writer thread, blocking only if the queue is full"""
+        self._writer_q.put(WriteJob(path, arr, kw, label, source))
+        
+    def wait_for_writes(self):
+        """Block until every queued write has been written"""
+        self._writer_q.join()
+        
+    def _writer_loop(self):
+        """Write queued TIFF outputs until a None sentinel arrives"""
+        while True:
+            job = self._writer_q.get()
+            try:
+                if job is None:
+                    return
+                tifffile.imwrite(job.path, job.arr, **job.kw)
+                self.logger.info(f"Saved {job.label}: {os.path.basename(job.path)}")
+            except Exception as e:
+                self.logger.error(f"Error writing {os.path.basename(job.path)}: {str(e)}")
+                self._write_failures.add(job.source)
+            finally:
+                self._writer_q.task_done()
+                
+    def shutdown_io(self):
+        """Finish pending writes and stop the background I/O workers"""
+        self._writer_q.put(None)
+        self._writer_thread.join()
+        self._io_pool.shutdown(wait=True)
+        
+    def segment_batch(self, model_instance, imgs, diameter, keep_flows=True):
+        """Run segmentation on a list of images, returning (masks, flows) per image"""
+        # Cellpose 4 evaluates a list one image at a time, so a list call only saves per-call
+        # overhead; images that need tiling go through segment_image instead
+        if len(imgs) > 1 and not any(needs_tiling(img) for img in imgs):
+            results = segment_images(model_instance, imgs, diameter)
+        else:
+            results = [self.segment_image(model_instance, img, diameter, keep_flows) for img in imgs]
+            
+        if not keep_flows:
+            # Release flow arrays now instead of holding them until the outputs are saved
+            results = [(masks, None) for masks, _ in results]
+        return results
+        
+    def segment_individually(self, model_instance, batch, diameter, keep_flows=True):
+        """Segment (tif_file, img) pairs one at a time, returning None for images that fail"""
+        results = []
+        for tif_file, img in batch:
+            try:
+                results.extend(self.segment_batch(model_instance, [img], diameter, keep_flows=keep_flows))
+            except Exception as e:
+                self.logger.error(f"Error segmenting {os.path.basename(tif_file)}: {str(e)}")
+                results.append(None)
+        return results
+        
+    def segment_image(self, model_instance, img, diameter, keep_flows=True):
+        """Segment a single image, tiling it first if it is too large"""
+        if needs_tiling(img):
+            return segment_tiled(model_instance, img, diameter, self.logger, keep_flows=keep_flows)
+        return segment_images(model_instance, [img], diameter)[0]
+        
+    def get_model(self, model_name, diameter):
+        """Return a cached Cellpose model, loading and warming it up on first use"""
+        key = (model_name, 'gpu')
+        model_instance = self._model_cache.get(key)
+        if model_instance is not None:
+            self.logger.info(f"Using cached Cellpose model: {model_name}")
+            return model_instance
+            
+        self.logger.info(f"Loading Cellpose model: {model_name}")
+        model_instance = models.CellposeModel(gpu=True, pretrained_model=model_name)
+        
+        # Let cuDNN pick the fastest convolution algorithms and allow TF32 matmuls
+        if torch is not None:
+            torch.backends.cudnn.benchmark = True
+            torch.set_float32_matmul_precision('high')
+        
+        # Warm up so kernel selection happens before the first real image
+        try:
+            with inference_context():
+                model_instance.eval(np.zeros((256, 256), dtype=np.uint8), diameter=diameter)
+        except Exception as e:
+            self.logger.warning(f"Model warmup failed: {e}")
+            
+        self._model_cache[key] = model_instance
+        return model_instance
+        
     def save_outputs(self, tif_file, img, masks, flows, output_folder, options):
         """Save selected output files"""
-        base_name = os.path.splitext(os.path.basename(tif_file))[0]
+        base_name = Path(tif_file).stem
         
         # Preprocess masks for compatibility
         processed_masks = self.preprocess_masks(masks)
@@ -442,68 +692,120 @@ class EnhancedCellposeGUI:
             self.logger.warning(f"Standard save failed: {e}, using custom save method")
         
         # Custom save for selected outputs
+        tiff_kwargs = {'compression': 'zlib', 'predictor': True} if options['compress_tiffs'] else {}
+        float_dtype = np.float16 if options['half_precision'] else np.float32
+        
         if options['save_masks']:
-            mask_file = os.path.join(output_folder, f"{base_name}_masks.tif")
-            tifffile.imwrite(mask_file, processed_masks.astype(np.uint16))
-            self.logger.info(f"Saved masks: {os.path.basename(mask_file)}")
+            mask_name = f"{base_name}_masks.tif"
+            mask_file = os.path.join(output_folder, mask_name)
+            # Remapped masks with more than 65535 cells are already uint32; keep that dtype
+            mask_dtype = np.uint32 if processed_masks.dtype == np.uint32 else np.uint16
+            self.submit_write(mask_file, processed_masks.astype(mask_dtype, copy=False), "masks", tif_file,
+                              **tiff_kwargs)
             
         if options['save_flows'] and flows and len(flows) > 1 and flows[1] is not None:
-            flows_file = os.path.join(output_folder, f"{base_name}_flows.tif")
-            tifffile.imwrite(flows_file, flows[1].astype(np.float32))
-            self.logger.info(f"Saved flows: {os.path.basename(flows_file)}")
+            flows_name = f"{base_name}_flows.tif"
+            flows_file = os.path.join(output_folder, flows_name)
+            self.submit_write(flows_file, flows[1].astype(float_dtype), "flows", tif_file, **tiff_kwargs)
             
         if options['save_cellprob'] and flows and len(flows) > 2 and flows[2] is not None:
-            cellprob_file = os.path.join(output_folder, f"{base_name}_cellprob.tif")
-            tifffile.imwrite(cellprob_file, flows[2].astype(np.float32))
-            self.logger.info(f"Saved cellprob: {os.path.basename(cellprob_file)}")
+            cellprob_name = f"{base_name}_cellprob.tif"
+            cellprob_file = os.path.join(output_folder, cellprob_name)
+            self.submit_write(cellprob_file, flows[2].astype(float_dtype), "cellprob", tif_file, **tiff_kwargs)
             
         if options['save_outlines']:
-            outlines = utils.masks_to_outlines(processed_masks)
-            outline_file = os.path.join(output_folder, f"{base_name}_outlines.tif")
-            tifffile.imwrite(outline_file, outlines.astype(np.uint8))
-            self.logger.info(f"Saved outlines: {os.path.basename(outline_file)}")
+            outlines = self._fast_outlines(processed_masks)
+            outline_name = f"{base_name}_outlines.tif"
+            outline_file = os.path.join(output_folder, outline_name)
+            self.submit_write(outline_file, outlines, "outlines", tif_file, **tiff_kwargs)
             
         if options['save_flow_rgb'] and flows and len(flows) > 0 and flows[0] is not None:
-            flow_rgb_file = os.path.join(output_folder, f"{base_name}_flows_rgb.png")
-            Image.fromarray(flows[0].astype(np.uint8)).save(flow_rgb_file)
-            self.logger.info(f"Saved flow RGB: {os.path.basename(flow_rgb_file)}")
+            flow_rgb_name = f"{base_name}_flows_rgb.png"
+            flow_rgb_file = os.path.join(output_folder, flow_rgb_name)
+            self.save_png(flow_rgb_file, flows[0].astype(np.uint8))
+            self.logger.info(f"Saved flow RGB: {flow_rgb_name}")
             
         if options['save_png_masks']:
             # Create colored mask visualization
-            mask_png_file = os.path.join(output_folder, f"{base_name}_masks.png")
+            mask_png_name = f"{base_name}_masks.png"
+            mask_png_file = os.path.join(output_folder, mask_png_name)
             mask_rgb = self.create_mask_visualization(processed_masks)
-            Image.fromarray(mask_rgb).save(mask_png_file)
-            self.logger.info(f"Saved mask PNG: {os.path.basename(mask_png_file)}")
+            self.save_png(mask_png_file, mask_rgb)
+            self.logger.info(f"Saved mask PNG: {mask_png_name}")
+            
+    def save_png(self, png_file, rgb):
+        """Save an RGB array as PNG, preferring OpenCV's faster encoder"""
+        # Level 3 balances speed and size; cv2.imwrite returns False on failure (e.g. non-ASCII paths)
+        if cv2 is not None and rgb.ndim == 3 and cv2.imwrite(
+                png_file, cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_PNG_COMPRESSION, 3]):
+            return
+        Image.fromarray(rgb).save(png_file)
+        
+    def run_on_device(self, func, masks):
+        """Run func(masks, xm) with CuPy when the masks fit on the GPU, otherwise with NumPy"""
+        if xp is not np and masks.size <= CUPY_MAX_PIXELS:
+            try:
+                return func(masks, xp)
+            except cp.cuda.memory.OutOfMemoryError:
+                self.logger.warning("GPU out of memory during mask post-processing, falling back to CPU")
+                self.free_gpu_arrays()
+        return func(masks, np)
+        
+    def free_gpu_arrays(self):
+        """Release blocks held by the CuPy memory pool"""
+        if xp is not np:
+            cp.get_default_memory_pool().free_all_blocks()
             
     def preprocess_masks(self, masks):
         """Preprocess masks to ensure data type compatibility"""
         if isinstance(masks, np.ndarray):
-            if masks.max() > 65535:
-                # Remap to sequential labels
-                unique_labels = np.unique(masks)
-                unique_labels = unique_labels[unique_labels > 0]
-                processed_masks = np.zeros_like(masks, dtype=np.uint16)
-                for i, label in enumerate(unique_labels):
-                    processed_masks[masks == label] = i + 1
-                return processed_masks
-            elif masks.max() > 255:
+            max_label = masks.max()
+            if max_label > 65535:
+                return self.run_on_device(self._renumber_masks, masks)
+            elif max_label > 255:
                 return masks.astype(np.uint16)
             else:
                 return masks
         return masks
         
+    def _renumber_masks(self, masks, xm):
+        """Remap labels to 1..K, using uint32 only when K does not fit in uint16"""
+        # Remap to sequential labels via the inverse index, which needs O(K) extra
+        # storage for K labels rather than a lookup table sized to the max label
+        unique_labels, inverse = xm.unique(xm.asarray(masks), return_inverse=True)
+        has_background = int(unique_labels[0]) == 0
+        if not has_background:
+            inverse += 1  # No background present, so labels still start at 1
+        # More than 65535 cells (e.g. large tiled images) would wrap around in uint16
+        n_labels = unique_labels.size - int(has_background)
+        label_dtype = xm.uint16 if n_labels <= 65535 else xm.uint32
+        return to_host(inverse.reshape(masks.shape).astype(label_dtype))
+        
+    def _fast_outlines(self, masks):
+        """Outline image (uint8) for the masks, computed on the GPU when CuPy is available"""
+        return self.run_on_device(lambda m, xm: to_host(fast_outlines(xm.asarray(m)).astype(xm.uint8)), masks)
+        
     def create_mask_visualization(self, masks):
         """Create a colored visualization of masks"""
-        if masks.max() == 0:
-            return np.zeros((*masks.shape, 3), dtype=np.uint8)
+        return self.run_on_device(self._colorize_masks, masks)
+        
+    def _colorize_masks(self, masks, xm):
+        """Map labels to palette colors with the given array module"""
+        # Labels cycle through the fixed palette, so colors are stable across images
+        if xm is np and _colorize is not None and masks.ndim == 2:
+            # Multi-threaded JIT gather into a preallocated output
+            mask_rgb = np.empty((*masks.shape, 3), dtype=np.uint8)
+            _colorize(masks, self._palette, mask_rgb)
+            return mask_rgb
             
-        # Create random colors for each label
-        colors = np.random.randint(0, 255, (masks.max() + 1, 3), dtype=np.uint8)
-        colors[0] = [0, 0, 0]  # Background black
-        
-        # Apply colors
-        mask_rgb = colors[masks]
-        return mask_rgb
+        masks_dev = xm.asarray(masks)
+        n_colors = self._palette.shape[0] - 1
+        color_index = xm.where(masks_dev > 0, (masks_dev.astype(xm.int64) - 1) % n_colors + 1, 0)
+        
+        # Apply colors (gather runs on the GPU when CuPy is used)
+        palette = self._palette if xm is np else self._palette_dev
+        mask_rgb = palette[color_index]
+        return to_host(mask_rgb)
 
 class GUILogHandler(logging.Handler):
     """Custom logging handler to display logs in GUI text widget"""
@@ -512,14 +814,32 @@ class GUILogHandler(logging.Handler):
         super().__init__()
         self.text_widget = text_widget
         
+        # Records may come from the worker thread; only the Tk main loop touches the widget
+        self.pending = queue.Queue()
+        self.text_widget.after(UI_REFRESH_MS, self.flush_pending)
+        
     def emit(self, record):
         try:
-            msg = self.format(record)
-            self.text_widget.insert(tk.END, msg + '\n')
-            self.text_widget.see(tk.END)
-            self.text_widget.update_idletasks()
+            self.pending.put(self.format(record))
         except:
             pass
+            
+    def flush_pending(self):
+        """Insert all queued log lines in a single widget update"""
+        lines = []
+        while True:
+            try:
+                lines.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+                
+        try:
+            if lines:
+                self.text_widget.insert(tk.END, '\n'.join(lines) + '\n')
+                self.text_widget.see(tk.END)
+            self.text_widget.after(UI_REFRESH_MS, self.flush_pending)
+        except tk.TclError:
+            pass  # Widget destroyed on exit
 
 def main():
     """Main function to run the enhanced GUI"""
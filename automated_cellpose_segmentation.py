@@ -7,13 +7,76 @@ Compatible with Python 3.13.5
 
 import os
 import sys
-import glob
 import argparse
 import logging
 from pathlib import Path
 import tkinter as tk
 from tkinter import filedialog, messagebox
 import subprocess
+import queue
+import threading
+import traceback
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Processing dependencies; guarded so --help and the installation checks still work without them
+try:
+    import numpy as np
+    import tifffile
+    from PIL import Image
+    from cellpose import models, io
+except ImportError:
+    np = tifffile = Image = models = io = None
+
+# Optional fast label remapping (falls back to NumPy)
+try:
+    import fastremap
+except ImportError:
+    fastremap = None
+
+# Compiled label remapping from scikit-image, used when fastremap is missing
+try:
+    from skimage.util import map_array
+except ImportError:
+    map_array = None
+
+# Optional GPU memory query for deciding when to tile
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# Images whose estimated GPU footprint exceeds free memory are segmented in overlapping tiles
+TILE_SIZE = 2048
+TILE_OVERLAP = 128
+GPU_BYTES_PER_PIXEL = 64  # Rough peak of network activations and flow outputs per input pixel
+
+# Images larger than this stay memory-mapped instead of being loaded into RAM; compressed
+# TIFFs above it are decoded into a temporary memory-mapped file
+MEMMAP_DECODE_BYTES = 1 << 30
+
+# Masks larger than this are written as tiled TIFFs
+TILED_WRITE_BYTES = 1 << 30
+
+# Shared pool for output writes so disk I/O overlaps the rest of the batch
+_IO_POOL = ThreadPoolExecutor(max_workers=4)
+
+# Installation facts shared by the check_* functions, filled in once by probe_environment
+_ENV = {}
+
+def probe_environment():
+    """Import cellpose and torch once and cache what the installation checks report"""
+    if not _ENV:
+        try:
+            import cellpose
+            _ENV['cellpose_installed'] = True
+            _ENV['cellpose_version'] = getattr(cellpose, '__version__', None)
+        except ImportError:
+            _ENV['cellpose_installed'] = False
+            _ENV['cellpose_version'] = None
+        _ENV['torch_version'] = torch.__version__ if torch is not None else None
+        _ENV['cuda_available'] = torch is not None and torch.cuda.is_available()
+    return _ENV
 
 def check_python_version():
     """Check if the Python version is compatible"""
@@ -33,34 +96,32 @@ def check_python_version():
 
 def check_cellpose_installation():
     """Check if Cellpose is installed and accessible"""
-    try:
-        import cellpose
-        try:
-            version = cellpose.__version__
-            print(f"Cellpose version: {version}")
-            if not version.startswith("4.0"):
-                print(f"Warning: Cellpose 4.0.x recommended, but {version} is installed")
-        except AttributeError:
-            print("Cellpose is installed (version detection unavailable)")
-        return True
-    except ImportError:
+    env = probe_environment()
+    if not env['cellpose_installed']:
         print("Error: Cellpose not found. Please install cellpose")
         return False
+    version = env['cellpose_version']
+    if version is None:
+        print("Cellpose is installed (version detection unavailable)")
+    else:
+        print(f"Cellpose version: {version}")
+        if not version.startswith("4.0"):
+            print(f"Warning: Cellpose 4.0.x recommended, but {version} is installed")
+    return True
 
 def check_torch_cuda():
     """Check if PyTorch with CUDA is available"""
-    try:
-        import torch
-        print(f"PyTorch version: {torch.__version__}")
-        if torch.cuda.is_available():
-            print("CUDA is available and working")
-            return True
-        else:
-            print("Warning: CUDA not available, will use CPU (slower)")
-            return False
-    except ImportError:
+    env = probe_environment()
+    if env['torch_version'] is None:
         print("Error: PyTorch not found")
         return False
+    print(f"PyTorch version: {env['torch_version']}")
+    if env['cuda_available']:
+        print("CUDA is available and working")
+        return True
+    else:
+        print("Warning: CUDA not available, will use CPU (slower)")
+        return False
 
 def select_folder(title="Select Folder"):
     """Open a folder selection dialog"""
@@ -75,16 +136,450 @@ def select_folder(title="Select Folder"):
 
 def get_tif_files(input_folder):
     """Get all .tif and .tiff files from the input folder"""
-    tif_patterns = ['*.tif', '*.tiff', '*.TIF', '*.TIFF']
-    tif_files = []
+    # Single directory pass with a case-insensitive extension test
+    with os.scandir(input_folder) as entries:
+        return sorted(entry.path for entry in entries
+                      if entry.is_file() and not entry.name.startswith('.')
+                      and entry.name.lower().endswith(('.tif', '.tiff')))
+
+def segment_images(model_instance, imgs, diameter):
+    """Run Cellpose on a list of images and return a (masks, flows) pair per image"""
+    # Channels parameter deprecated in Cellpose-SAM 4.0.6+
+    with inference_context():
+        result = model_instance.eval(
+            imgs, 
+            diameter=diameter,
+            flow_threshold=0.4,
+            cellprob_threshold=0.0
+        )
+    # Handle different return formats between Cellpose versions
+    if len(result) == 4:
+        masks, flows, styles, diams = result
+    elif len(result) == 3:
+        masks, flows, styles = result
+        diams = None
+    else:
+        raise ValueError(f"Unexpected eval return format: {len(result)} values")
+    return list(zip(masks, flows))
+
+def compile_network(model_instance, logger):
+    """Replace the model's network with a torch.compile'd version, keeping the original on failure"""
+    if torch is None or not hasattr(torch, 'compile'):
+        logger.warning("torch.compile is not available - running the uncompiled network")
+        return
+    try:
+        # Room for several input shapes (e.g. full images and tiles) before recompiles evict graphs
+        torch._dynamo.config.cache_size_limit = 16
+        model_instance.net = torch.compile(model_instance.net, mode='reduce-overhead', fullgraph=False)
+        logger.info("Compiled network with torch.compile; the first image includes compile time")
+    except Exception as e:
+        logger.warning(f"torch.compile failed, running the uncompiled network: {e}")
+
+def inference_context():
+    """Return a mixed-precision autocast context on CUDA, or a no-op context otherwise"""
+    if torch is not None and torch.cuda.is_available():
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        return torch.autocast('cuda', dtype=dtype)
+    return contextlib.nullcontext()
+
+def spatial_shape(img):
+    """Return (height, width) for 2D, channels-last or channels-first images"""
+    if img.ndim == 3 and img.shape[0] <= 4:
+        return img.shape[1:]
+    return img.shape[:2]
+
+def needs_tiling(img):
+    """Check whether segmenting the whole image at once is likely to exhaust GPU memory"""
+    if torch is None or not torch.cuda.is_available() or img.ndim not in (2, 3):
+        return False
+    height, width = spatial_shape(img)
+    if height <= TILE_SIZE and width <= TILE_SIZE:
+        return False
+    # Memory cached by PyTorch's allocator but not in use is also available to the model
+    free_bytes, _ = torch.cuda.mem_get_info()
+    free_bytes += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    return height * width * GPU_BYTES_PER_PIXEL > free_bytes
+
+def tile_origins(length, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Start offsets of overlapping tiles covering [0, length), the last one flush with the end"""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    starts.append(length - tile)
+    return starts
+
+def merge_tile_labels(region, tile_masks, label_offset):
+    """
+    Relabel a tile's masks for stitching into the region it covers
+    
+    Each tile label takes the stitched label it overlaps most (a majority vote
+    over the overlap), so cells cut by a tile edge keep one ID; the remaining
+    labels are shifted by label_offset to stay unique.
+    """
+    lut = np.arange(int(tile_masks.max()) + 1, dtype=np.uint32) + label_offset
+    lut[0] = 0
+    overlap = (region > 0) & (tile_masks > 0)
+    if overlap.any():
+        # Count (tile label, stitched label) pairs and keep the most frequent pair per tile label
+        pairs, counts = np.unique(np.stack([tile_masks[overlap], region[overlap]]), axis=1, return_counts=True)
+        order = np.lexsort((counts, pairs[0]))
+        tile_labels, stitched_labels = pairs[0][order], pairs[1][order]
+        last = np.append(tile_labels[1:] != tile_labels[:-1], True)
+        lut[tile_labels[last]] = stitched_labels[last]
+    return lut[tile_masks]
+
+def paste_flows(full_flows, tile_flows, y0, x0, tile_hw, full_hw, where):
+    """
+    Copy each per-pixel flow output of a tile into a full-size buffer with the same layout
+    
+    Only pixels selected by the (height, width) boolean `where` are copied, so
+    overlaps follow the same rule as the stitched masks.
+    """
+    th, tw = tile_hw
+    for k, component in enumerate(tile_flows):
+        component = np.asarray(component)
+        if k == len(full_flows):
+            # Allocate on the first tile; outputs that are not per-pixel are dropped
+            if component.shape[:2] == tile_hw:
+                full_flows.append(np.zeros((*full_hw, *component.shape[2:]), dtype=component.dtype))
+            elif component.shape[-2:] == tile_hw:
+                full_flows.append(np.zeros((*component.shape[:-2], *full_hw), dtype=component.dtype))
+            else:
+                full_flows.append(None)
+        
+        buffer = full_flows[k]
+        if buffer is None:
+            continue
+        if buffer.shape[:2] == full_hw:
+            np.copyto(buffer[y0:y0 + th, x0:x0 + tw], component,
+                      where=where.reshape(where.shape + (1,) * (component.ndim - 2)))
+        else:
+            np.copyto(buffer[..., y0:y0 + th, x0:x0 + tw], component, where=where)
+
+def segment_tiled(model_instance, img, diameter, logger, keep_flows=True):
+    """Segment a large image in overlapping tiles and stitch masks (and flows if kept) back together"""
+    if img.ndim == 3 and img.shape[0] <= 4:
+        img = np.moveaxis(img, 0, -1)  # Channels last so tiles cut the spatial axes
+    height, width = img.shape[:2]
+    
+    origins = [(y0, x0) for y0 in tile_origins(height) for x0 in tile_origins(width)]
+    logger.info(f"Large image ({width}x{height}) - segmenting {len(origins)} overlapping tiles")
+    
+    stitched = np.zeros((height, width), dtype=np.uint32)
+    stitched_flows = []
+    label_offset = 0
+    for y0, x0 in origins:
+        # One tile per eval call, stitched before the next, so only one tile's outputs are held
+        [(tile_masks, tile_flows)] = segment_images(
+            model_instance, [img[y0:y0 + TILE_SIZE, x0:x0 + TILE_SIZE]], diameter)
+        th, tw = tile_masks.shape[:2]
+        
+        # Merge cells shared with earlier tiles and fill only pixels not yet labelled;
+        # flows and cellprob come from the same tile as the mask at each pixel
+        region = stitched[y0:y0 + th, x0:x0 + tw]
+        unlabelled = region == 0
+        np.copyto(region, merge_tile_labels(region, tile_masks, label_offset), where=unlabelled)
+        label_offset += int(tile_masks.max())
+        if keep_flows:
+            paste_flows(stitched_flows, tile_flows, y0, x0, (th, tw), (height, width), unlabelled)
+    
+    return stitched, stitched_flows if keep_flows else None
+
+def read_image(tif_file):
+    """
+    Memory-map a TIFF where possible, falling back to a full read
     
-    for pattern in tif_patterns:
-        tif_files.extend(glob.glob(os.path.join(input_folder, pattern)))
+    Uncompressed, contiguous files are mapped directly. Large compressed or
+    multi-page files are decoded page by page into a temporary memory-mapped
+    array, so host RAM does not have to hold the whole decoded image.
+    """
+    try:
+        return tifffile.memmap(tif_file, mode='r')
+    except Exception:
+        pass
+    try:
+        with tifffile.TiffFile(tif_file) as tif:
+            series = tif.series[0]
+            if series.size * series.dtype.itemsize > MEMMAP_DECODE_BYTES:
+                return tif.asarray(out='memmap')
+    except Exception:
+        pass
+    return io.imread(tif_file)
+
+def load_image(tif_file):
+    """
+    Read an image and stage it in host memory ready for inference
     
-    # Remove duplicates and sort
-    return sorted(list(set(tif_files)))
+    Run on the prefetch thread, so memory-mapped files are paged in while the
+    GPU works on the previous batch. Only images over MEMMAP_DECODE_BYTES stay
+    memory-mapped; they are paged in during inference, one tile at a time if
+    process_batch tiles them.
+    """
+    img = read_image(tif_file)
+    if isinstance(img, np.memmap) and img.nbytes <= MEMMAP_DECODE_BYTES:
+        img = np.array(img)
+    return img
+
+def fast_outlines(masks):
+    """Mark labelled pixels whose label differs from a 4-connected neighbour"""
+    outlines = ((masks != np.roll(masks, 1, 0)) | (masks != np.roll(masks, -1, 0)) |
+                (masks != np.roll(masks, 1, 1)) | (masks != np.roll(masks, -1, 1)))
+    # Nonzero labels count as true, so background is cleared without a full-size comparison array
+    np.logical_and(outlines, masks, out=outlines)
+    return outlines
+
+def write_mask(path, arr, tile=(512, 512)):
+    """Write a mask as a compressed TIFF, tiled only when it is very large"""
+    # Tiles let viewers read regions of huge masks; for ordinary sizes they only add overhead
+    if arr.ndim == 2 and arr.nbytes > TILED_WRITE_BYTES:
+        tifffile.imwrite(path, arr, tile=tile, compression='zlib')
+    else:
+        tifffile.imwrite(path, arr, compression='zlib')
+
+def queue_write(pending_writes, tif_file, description, write, *args, required=False, **kwargs):
+    """Run a file write on the shared I/O pool and record it for wait_for_writes"""
+    pending_writes.append((tif_file, description, required, _IO_POOL.submit(write, *args, **kwargs)))
+
+def wait_for_writes(pending_writes, logger):
+    """Wait for queued writes and return the input files whose required outputs failed"""
+    failed = set()
+    for tif_file, description, required, future in pending_writes:
+        try:
+            future.result()
+            logger.info(f"Saved {description}")
+        except Exception as e:
+            if required:
+                logger.error(f"Error saving {description}: {e}")
+                failed.add(tif_file)
+            else:
+                logger.warning(f"Error saving {description}: {e}")
+    pending_writes.clear()
+    return failed
 
-def run_cellpose_batch(input_folder, output_folder, model='cpsam', diameter=None, channels=[0,0]):
+def prefetch_images(tif_files, read_image, depth=4):
+    """
+    Read images on a background thread, yielding (tif_file, img, error) in order
+    
+    At most `depth` decoded images wait in the queue, which bounds memory use
+    while the consumer keeps the GPU busy.
+    """
+    pending = queue.Queue(maxsize=depth)
+    
+    def reader():
+        for tif_file in tif_files:
+            try:
+                pending.put((tif_file, read_image(tif_file), None))
+            except Exception as e:
+                pending.put((tif_file, None, e))
+        pending.put(None)
+    
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        item = pending.get()
+        if item is None:
+            return
+        yield item
+
+def log_eval_failure(tif_file, error, logger):
+    """Log a model.eval failure for one file, with the traceback of the exception being handled"""
+    logger.error(f"Error during model.eval: {error}")
+    logger.error(f"Full traceback: {traceback.format_exc()}")
+    logger.error(f"Failed to process {os.path.basename(tif_file)}: {str(error)}")
+
+def process_batch(model_instance, batch, diameter, output_folder, logger):
+    """
+    Segment a batch of (tif_file, img) pairs in one eval call and save the results
+    
+    Returns:
+        tuple: (number of files processed successfully, list of failed files)
+    """
+    success_count = 0
+    failed_files = []
+    
+    # Run segmentation on the whole batch in one eval call; very large images are tiled separately
+    logger.info(f"Running segmentation on {len(batch)} image(s) with diameter={diameter}")
+    tiled = [needs_tiling(img) for _, img in batch]
+    results = None
+    try:
+        direct = [img for (_, img), is_tiled in zip(batch, tiled) if not is_tiled]
+        direct_results = iter(segment_images(model_instance, direct, diameter) if direct else [])
+        results = [segment_tiled(model_instance, img, diameter, logger) if is_tiled else next(direct_results)
+                   for (_, img), is_tiled in zip(batch, tiled)]
+    except Exception as eval_error:
+        if len(batch) == 1:
+            log_eval_failure(batch[0][0], eval_error, logger)
+            failed_files.append(batch[0][0])
+            results = [None]
+        else:
+            # Cellpose evaluates list inputs one image at a time anyway, so retry each image
+            # on its own rather than failing the whole batch for one bad image
+            logger.warning(f"Batch eval failed ({eval_error}), retrying images one at a time")
+    
+    # Retry outside the handler so the failed call's frames (and GPU tensors) are released first
+    if results is None:
+        results = []
+        for (tif_file, img), is_tiled in zip(batch, tiled):
+            try:
+                if is_tiled:
+                    results.append(segment_tiled(model_instance, img, diameter, logger))
+                else:
+                    results.extend(segment_images(model_instance, [img], diameter))
+            except Exception as image_error:
+                log_eval_failure(tif_file, image_error, logger)
+                failed_files.append(tif_file)
+                results.append(None)
+    
+    pending_writes = []
+    cell_counts = {}
+    for (tif_file, img), result in zip(batch, results):
+        if result is None:
+            continue
+        masks, flows = result
+        try:
+            cell_counts[tif_file] = save_segmentation(tif_file, img, masks, flows, output_folder, logger, pending_writes)
+            
+        except Exception as e:
+            logger.error(f"Failed to process {os.path.basename(tif_file)}: {str(e)}")
+            failed_files.append(tif_file)
+    
+    # Files only count as processed once their queued writes have finished
+    write_failures = wait_for_writes(pending_writes, logger)
+    for tif_file, cell_count in cell_counts.items():
+        if tif_file in write_failures:
+            logger.error(f"Failed to process {os.path.basename(tif_file)}: masks could not be saved")
+            failed_files.append(tif_file)
+        else:
+            logger.info(f"Successfully processed {os.path.basename(tif_file)} - {cell_count} cells found")
+            success_count += 1
+    
+    return success_count, failed_files
+
+def save_segmentation(tif_file, img, masks, flows, output_folder, logger, pending_writes):
+    """
+    Count cells and save masks, flows and outlines for one segmented image
+    
+    Files written by the fallback save path are queued on the I/O pool and
+    recorded in pending_writes; the caller waits for them.
+    
+    Returns:
+        int: Number of cells found
+    """
+    # Count cells (unique labels excluding 0) and prepare masks for saving
+    processed_masks = masks
+    max_label = 0
+    if isinstance(masks, list):
+        cell_count = len(masks) if masks else 0
+    elif fastremap is not None:
+        # One renumbering pass yields sequential labels, so the count is also the largest label
+        processed_masks, remapping = fastremap.renumber(masks, preserve_zero=True, in_place=False)
+        cell_count = len(remapping) - int(0 in remapping)
+        max_label = cell_count
+        # Narrowest unsigned dtype that holds the labels, without rescanning the array
+        processed_masks = fastremap.refit(processed_masks, value=max_label)
+    else:
+        # One sorted unique pass; label 0 (background) can only be first
+        unique_labels = np.unique(masks)
+        cell_count = unique_labels.size - int(unique_labels.size > 0 and unique_labels[0] == 0)
+        max_label = int(unique_labels[-1]) if unique_labels.size else 0
+    logger.info(f"Segmentation completed - found {cell_count} cells")
+    
+    # Generate output filename
+    base_name = os.path.splitext(os.path.basename(tif_file))[0]
+    
+    # Without fastremap, fit the masks into a dtype compatible with save_masks
+    if isinstance(masks, np.ndarray) and fastremap is None:
+        # Check if mask values exceed uint16 range and need remapping
+        if max_label > 65535:
+            logger.info(f"Masks contain values > 65535 (max: {max_label}), remapping to sequential labels")
+            # Remap to sequential labels starting from 1, reusing the unique labels computed for the cell count
+            unique_labels = unique_labels[unique_labels > 0]  # Remove background (0)
+            label_dtype = np.uint16 if len(unique_labels) <= 65535 else np.uint32
+            new_labels = np.arange(1, len(unique_labels) + 1, dtype=label_dtype)
+            if map_array is not None:
+                # Hash-map lookup in a compiled loop; memory does not depend on the label values
+                processed_masks = map_array(masks, unique_labels, new_labels)
+            else:
+                # Lookup table indexed by old label, so each output pixel is written once
+                lut = np.zeros(max_label + 1, dtype=label_dtype)
+                lut[unique_labels] = new_labels
+                processed_masks = lut[masks]
+            max_label = len(unique_labels)
+            logger.info(f"Remapped {max_label} labels to range 1-{max_label}")
+        elif max_label > 255:
+            # Convert to uint16 if values exceed uint8 but fit in uint16
+            processed_masks = masks.astype(np.uint16, copy=False)
+        else:
+            # Keep as original type if values fit in uint8
+            processed_masks = masks
+    
+    try:
+        # Try the standard save_masks function with preprocessed masks
+        io.save_masks(
+            img, 
+            processed_masks, 
+            flows, 
+            tif_file, 
+            savedir=output_folder,
+            save_flows=True,
+            save_outlines=True
+        )
+        logger.info(f"Successfully saved all files using standard method")
+        
+    except Exception as save_error:
+        logger.warning(f"Error saving with save_masks: {save_error}")
+        logger.info("Using alternative save method for flows and masks...")
+        
+        # Alternative comprehensive save approach
+        # 1. Save masks with proper data type
+        if isinstance(processed_masks, np.ndarray):
+            mask_file = os.path.join(output_folder, f"{base_name}_masks.tif")
+            masks_save = processed_masks.astype(np.uint16 if max_label < 65535 else np.uint32, copy=False)
+            queue_write(pending_writes, tif_file, f"masks to {mask_file}", write_mask, mask_file, masks_save,
+                        required=True)
+        
+        # 2. Save flows data if available
+        # Flows lie in [-1, 1] and cellprob is a bounded logit, so half precision is
+        # plenty; set CELLPOSE_FULL_PRECISION=1 to keep float32
+        full_precision = os.environ.get("CELLPOSE_FULL_PRECISION") == "1"
+        float_dtype = np.float32 if full_precision else np.float16
+        if flows and len(flows) > 0:
+            try:
+                # Save flow fields (flows[1] contains the actual flow vectors)
+                if len(flows) > 1 and flows[1] is not None:
+                    flows_file = os.path.join(output_folder, f"{base_name}_flows.tif")
+                    flow_data = flows[1].astype(float_dtype)
+                    queue_write(pending_writes, tif_file, f"flows to {flows_file}",
+                                tifffile.imwrite, flows_file, flow_data, compression='zlib')
+                
+                # Save cell probability (flows[2] contains cellprob)
+                if len(flows) > 2 and flows[2] is not None:
+                    cellprob_file = os.path.join(output_folder, f"{base_name}_cellprob.tif")
+                    cellprob_data = flows[2].astype(float_dtype)
+                    queue_write(pending_writes, tif_file, f"cell probability to {cellprob_file}",
+                                tifffile.imwrite, cellprob_file, cellprob_data, compression='zlib')
+                    
+                # Save flow visualization (flows[0] contains RGB flow)
+                if len(flows) > 0 and flows[0] is not None:
+                    flow_rgb_file = os.path.join(output_folder, f"{base_name}_flows_rgb.png")
+                    flow_rgb = flows[0].astype(np.uint8)
+                    queue_write(pending_writes, tif_file, f"flow RGB to {flow_rgb_file}",
+                                Image.fromarray(flow_rgb).save, flow_rgb_file)
+                    
+            except Exception as flow_error:
+                logger.warning(f"Error saving flows: {flow_error}")
+        
+        # 3. Save basic outlines if possible
+        try:
+            outlines = fast_outlines(processed_masks)
+            outline_file = os.path.join(output_folder, f"{base_name}_outlines.tif")
+            queue_write(pending_writes, tif_file, f"outlines to {outline_file}",
+                        tifffile.imwrite, outline_file, outlines.astype(np.uint8))
+        except Exception as outline_error:
+            logger.warning(f"Error saving outlines: {outline_error}")
+    
+    return cell_count
+
+def run_cellpose_batch(input_folder, output_folder, model='cpsam', diameter=None, channels=[0,0], batch_size=4, compile_model=False):
     """
     Run Cellpose batch processing on all .tif files in input folder
     
@@ -94,6 +589,8 @@ def run_cellpose_batch(input_folder, output_folder, model='cpsam', diameter=None
         model (str): Cellpose model to use (default: 'cpsam')
         diameter (float): Cell diameter (0 for auto-detection)
         channels (list): Channel configuration [cytoplasm, nucleus]
+        batch_size (int): Number of images passed to the model per eval call
+        compile_model (bool): Compile the network with torch.compile before inference
     """
     
     # Get all .tif files
@@ -124,159 +621,48 @@ def run_cellpose_batch(input_folder, output_folder, model='cpsam', diameter=None
     logger.info(f"Input folder: {input_folder}")
     logger.info(f"Output folder: {output_folder}")
     logger.info(f"Model: {model}")
+    logger.info(f"Batch size: {batch_size}")
     
     success_count = 0
     failed_files = []
     
     try:
-        from cellpose import models, io
+        if models is None:
+            raise ImportError("cellpose, numpy, tifffile and Pillow are required for segmentation")
         
         # Initialize model
         logger.info(f"Loading Cellpose model: {model}")
         model_instance = models.CellposeModel(gpu=True, pretrained_model=model)
         
-        for i, tif_file in enumerate(tif_files, 1):
-            try:
-                logger.info(f"Processing file {i}/{len(tif_files)}: {os.path.basename(tif_file)}")
-                
-                # Read image
-                img = io.imread(tif_file)
+        # Let cuDNN pick the fastest convolution algorithms for the repeated tile shape
+        if torch is not None:
+            torch.backends.cudnn.benchmark = True
+        
+        if compile_model:
+            compile_network(model_instance, logger)
+        
+        # Images are decoded on a background thread while earlier batches are on the GPU
+        batch = []
+        for i, (tif_file, img, read_error) in enumerate(prefetch_images(tif_files, load_image), 1):
+            logger.info(f"Processing file {i}/{len(tif_files)}: {os.path.basename(tif_file)}")
+            if read_error is not None:
+                logger.error(f"Failed to process {os.path.basename(tif_file)}: {str(read_error)}")
+                failed_files.append(tif_file)
+            else:
                 logger.info(f"Image shape: {img.shape}")
                 logger.info(f"Image dtype: {img.dtype}")
-                logger.info(f"Image min/max: {img.min()}/{img.max()}")
-                
-                # Run segmentation (channels parameter deprecated in Cellpose-SAM 4.0.6+)
-                logger.info(f"Running segmentation with diameter={diameter}")
-                try:
-                    result = model_instance.eval(
-                        img, 
-                        diameter=diameter,
-                        flow_threshold=0.4,
-                        cellprob_threshold=0.0
-                    )
-                    # Handle different return formats between Cellpose versions
-                    if len(result) == 4:
-                        masks, flows, styles, diams = result
-                    elif len(result) == 3:
-                        masks, flows, styles = result
-                        diams = None
-                    else:
-                        logger.error(f"Unexpected return format: {len(result)} values")
-                        raise ValueError(f"Unexpected eval return format")
-                        
-                    # Count cells (unique labels excluding 0)
-                    if isinstance(masks, list):
-                        cell_count = len(masks) if masks else 0
-                    else:
-                        import numpy as np
-                        cell_count = len(np.unique(masks)) - 1 if 0 in np.unique(masks) else len(np.unique(masks))
-                    logger.info(f"Segmentation completed - found {cell_count} cells")
-                    
-                except Exception as eval_error:
-                    logger.error(f"Error during model.eval: {eval_error}")
-                    import traceback
-                    logger.error(f"Full traceback: {traceback.format_exc()}")
-                    raise eval_error
-                
-                # Generate output filename
-                base_name = os.path.splitext(os.path.basename(tif_file))[0]
-                
-                # Save results with proper data type handling
-                import numpy as np
-                base_name = os.path.splitext(os.path.basename(tif_file))[0]
-                
-                # Preprocess masks to ensure compatibility with save_masks
-                processed_masks = masks
-                if isinstance(masks, np.ndarray):
-                    # Check if mask values exceed uint16 range and need remapping
-                    if masks.max() > 65535:
-                        logger.info(f"Masks contain values > 65535 (max: {masks.max()}), remapping to sequential labels")
-                        # Remap to sequential labels starting from 1
-                        unique_labels = np.unique(masks)
-                        unique_labels = unique_labels[unique_labels > 0]  # Remove background (0)
-                        processed_masks = np.zeros_like(masks, dtype=np.uint16)
-                        for i, label in enumerate(unique_labels):
-                            processed_masks[masks == label] = i + 1
-                        logger.info(f"Remapped {len(unique_labels)} labels to range 1-{len(unique_labels)}")
-                    elif masks.max() > 255:
-                        # Convert to uint16 if values exceed uint8 but fit in uint16
-                        processed_masks = masks.astype(np.uint16)
-                    else:
-                        # Keep as original type if values fit in uint8
-                        processed_masks = masks
-                
-                try:
-                    # Try the standard save_masks function with preprocessed masks
-                    io.save_masks(
-                        img, 
-                        processed_masks, 
-                        flows, 
-                        tif_file, 
-                        savedir=output_folder,
-                        save_flows=True,
-                        save_outlines=True
-                    )
-                    logger.info(f"Successfully saved all files using standard method")
-                    
-                except Exception as save_error:
-                    logger.warning(f"Error saving with save_masks: {save_error}")
-                    logger.info("Using alternative save method for flows and masks...")
-                    
-                    # Alternative comprehensive save approach
-                    from PIL import Image
-                    import tifffile
-                    
-                    # 1. Save masks with proper data type
-                    if isinstance(processed_masks, np.ndarray):
-                        mask_file = os.path.join(output_folder, f"{base_name}_masks.tif")
-                        masks_save = processed_masks.astype(np.uint16) if processed_masks.max() < 65535 else processed_masks.astype(np.uint32)
-                        tifffile.imwrite(mask_file, masks_save)
-                        logger.info(f"Saved masks to {mask_file}")
-                    
-                    # 2. Save flows data if available
-                    if flows and len(flows) > 0:
-                        try:
-                            # Save flow fields (flows[1] contains the actual flow vectors)
-                            if len(flows) > 1 and flows[1] is not None:
-                                flows_file = os.path.join(output_folder, f"{base_name}_flows.tif")
-                                flow_data = flows[1].astype(np.float32)
-                                tifffile.imwrite(flows_file, flow_data)
-                                logger.info(f"Saved flows to {flows_file}")
-                            
-                            # Save cell probability (flows[2] contains cellprob)
-                            if len(flows) > 2 and flows[2] is not None:
-                                cellprob_file = os.path.join(output_folder, f"{base_name}_cellprob.tif")
-                                cellprob_data = flows[2].astype(np.float32)
-                                tifffile.imwrite(cellprob_file, cellprob_data)
-                                logger.info(f"Saved cell probability to {cellprob_file}")
-                                
-                            # Save flow visualization (flows[0] contains RGB flow)
-                            if len(flows) > 0 and flows[0] is not None:
-                                flow_rgb_file = os.path.join(output_folder, f"{base_name}_flows_rgb.png")
-                                flow_rgb = flows[0].astype(np.uint8)
-                                Image.fromarray(flow_rgb).save(flow_rgb_file)
-                                logger.info(f"Saved flow RGB to {flow_rgb_file}")
-                                
-                        except Exception as flow_error:
-                            logger.warning(f"Error saving flows: {flow_error}")
-                    
-                    # 3. Save basic outlines if possible
-                    try:
-                        from cellpose import utils
-                        outlines = utils.masks_to_outlines(processed_masks)
-                        outline_file = os.path.join(output_folder, f"{base_name}_outlines.tif")
-                        tifffile.imwrite(outline_file, outlines.astype(np.uint8))
-                        logger.info(f"Saved outlines to {outline_file}")
-                    except Exception as outline_error:
-                        logger.warning(f"Error saving outlines: {outline_error}")
-                
-                logger.info(f"Successfully processed {os.path.basename(tif_file)} - {cell_count} cells found")
-                success_count += 1
-                
-            except Exception as e:
-                logger.error(f"Failed to process {os.path.basename(tif_file)}: {str(e)}")
-                failed_files.append(tif_file)
-                continue
+                # Two full-image reductions, so only computed when debug output is wanted
+                if logger.isEnabledFor(logging.DEBUG):
+                    img_min, img_max = fastremap.minmax(img) if fastremap is not None else (img.min(), img.max())
+                    logger.debug(f"Image min/max: {img_min}/{img_max}")
+                batch.append((tif_file, img))
+            
+            # Segment once the batch is full or the last file has been read
+            if batch and (len(batch) == batch_size or i == len(tif_files)):
+                succeeded, failed = process_batch(model_instance, batch, diameter, output_folder, logger)
+                success_count += succeeded
+                failed_files.extend(failed)
+                batch = []
     
     except Exception as e:
         logger.error(f"Error initializing Cellpose: {str(e)}")
@@ -302,9 +688,13 @@ def main():
     parser.add_argument('--diameter', '-d', type=float, default=None, help='Cell diameter (None for auto)')
     parser.add_argument('--chan1', type=int, default=0, help='Cytoplasm channel (default: 0)')
     parser.add_argument('--chan2', type=int, default=0, help='Nucleus channel (default: 0)')
+    parser.add_argument('--batch-size', '-b', type=int, default=4, help='Images per model eval call (default: 4)')
+    parser.add_argument('--compile', action='store_true', help='Compile the network with torch.compile (slower start, faster inference)')
     parser.add_argument('--gui', action='store_true', help='Use GUI for folder selection')
     
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
     
     print("=" * 60)
     print("Automated Cellpose Segmentation")
@@ -368,7 +758,9 @@ def main():
         output_folder=output_folder,
         model=args.model,
         diameter=args.diameter,
-        channels=[args.chan1, args.chan2]
+        channels=[args.chan1, args.chan2],
+        batch_size=args.batch_size,
+        compile_model=args.compile
     )
     
     if success: